@@ -1,100 +1,162 @@
+import io
+import logging
 import psycopg2
+from psycopg2.extras import execute_values
+from pgcopy import CopyManager
 from netCDF4 import Dataset, num2date, chartostring
 import numpy as np
 import os
+from concurrent.futures import ProcessPoolExecutor
 
-# ✅ Connect to PostgreSQL
-conn = psycopg2.connect(
+logger = logging.getLogger(__name__)
+
+# ✅ PostgreSQL connection settings
+DB_CONFIG = dict(
     dbname="ocean_db2",   # your database name
     user="postgres",
     password="9669",   # change to your password
     host="localhost",
     port="5432"
 )
-cur = conn.cursor()
-
-# ✅ Create table if not exists
-cur.execute("""
-CREATE TABLE IF NOT EXISTS argo_profile_data (
-    id SERIAL PRIMARY KEY,
-    float_id VARCHAR(50),
-    cycle_number INT,
-    juld TIMESTAMP,
-    latitude DOUBLE PRECISION,
-    longitude DOUBLE PRECISION,
-    pressure DOUBLE PRECISION,
-    temperature DOUBLE PRECISION,
-    salinity DOUBLE PRECISION
-);
-""")
-conn.commit()
+
+
+def get_db_connection():
+    """Opens a new connection; each worker process owns its own."""
+    return psycopg2.connect(**DB_CONFIG)
+
+
+def create_table():
+    """Creates the target table if it does not exist yet."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS argo_profile_data (
+                id SERIAL PRIMARY KEY,
+                float_id VARCHAR({FLOAT_ID_MAX_LENGTH}),
+                cycle_number INT,
+                juld TIMESTAMP,
+                latitude DOUBLE PRECISION,
+                longitude DOUBLE PRECISION,
+                pressure DOUBLE PRECISION,
+                temperature DOUBLE PRECISION,
+                salinity DOUBLE PRECISION
+            );
+            """)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+FLOAT_ID_MAX_LENGTH = 50
+COLUMNS = ["float_id", "cycle_number", "juld", "latitude", "longitude", "pressure", "temperature", "salinity"]
+INSERT_SQL = f"INSERT INTO argo_profile_data ({', '.join(COLUMNS)}) VALUES %s"
+
+
+def insert_values(conn, cur, rows, nc_file):
+    """Inserts rows with execute_values, splitting failed batches in half to isolate bad rows."""
+    try:
+        # One multi-row INSERT per page of 500 rows, parsed and planned once per statement
+        execute_values(cur, INSERT_SQL, rows, page_size=500)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        if len(rows) == 1:
+            print(f"❌ ERROR on Cycle {rows[0][1]} in {os.path.basename(nc_file)}: {e}")
+            return
+        mid = len(rows) // 2
+        insert_values(conn, cur, rows[:mid], nc_file)
+        insert_values(conn, cur, rows[mid:], nc_file)
+
+
+def insert_rows(conn, cur, rows, nc_file):
+    """Streams all rows of one file with a single binary COPY and one commit."""
+    if not rows:
+        return
+    logger.debug("Inserting %d rows from %s", len(rows), os.path.basename(nc_file))
+    # pgcopy silently truncates varchar values to the column length, so reject oversized IDs up front
+    too_long = [row[0] for row in rows if row[0] is not None and len(row[0]) > FLOAT_ID_MAX_LENGTH]
+    if too_long:
+        raise ValueError(f"{len(too_long)} float_id values exceed {FLOAT_ID_MAX_LENGTH} characters, e.g. {too_long[0][:80]!r}")
+    try:
+        # Binary COPY sends floats and timestamps packed, skipping text formatting and parsing
+        CopyManager(conn, "argo_profile_data", COLUMNS).copy(rows, io.BytesIO)
+        conn.commit()
+    except Exception as e:
+        # COPY is all-or-nothing, so retry the file with a multi-row INSERT
+        print(f"⚠️ COPY failed for {os.path.basename(nc_file)}, falling back to INSERT: {e}")
+        conn.rollback()
+        insert_values(conn, cur, rows, nc_file)
+
+
+def profile_means(var):
+    """Mean of each profile (row) of a NetCDF variable, or None where no level holds valid data."""
+    # Read as a plain ndarray; building the MaskedArray costs an extra full pass over the data
+    var.set_auto_mask(False)
+    values = var[:]
+    # Same rules netCDF4's auto-masking applies: fill value, missing value and valid range
+    invalid = np.isnan(values)
+    for attr in ("_FillValue", "missing_value"):
+        if hasattr(var, attr):
+            invalid |= np.isin(values, getattr(var, attr))
+    valid_min, valid_max = getattr(var, "valid_range", (getattr(var, "valid_min", None), getattr(var, "valid_max", None)))
+    if valid_min is not None:
+        invalid |= values < valid_min
+    if valid_max is not None:
+        invalid |= values > valid_max
+    counts = (~invalid).sum(axis=1)
+    sums = np.where(invalid, 0, values).sum(axis=1, dtype=np.float64)
+    means = np.divide(sums, counts, out=np.full(len(counts), np.nan), where=counts > 0)
+    return [None if np.isnan(m) else m for m in means.tolist()]
 
 
 # ✅ THIS IS THE FUNCTION YOU NEED TO COPY AND PASTE
 def process_nc_file(nc_file):
     try:
-        ds = Dataset(nc_file, "r")
-        
-        # Extract metadata
-        float_id = chartostring(ds.variables["PLATFORM_NUMBER"][:]).tobytes().decode("utf-8").strip().replace("\x00", "")
-        cycles = ds.variables["CYCLE_NUMBER"][:]
-        julds = ds.variables["JULD"][:]
-        latitudes = ds.variables["LATITUDE"][:]
-        longitudes = ds.variables["LONGITUDE"][:]
-
-        # Convert JULD → datetime
-        time_units = ds.variables["JULD"].units
-        time_calendar = getattr(ds.variables["JULD"], "calendar", "standard")
-        times = num2date(julds, units=time_units, calendar=time_calendar)
-
-        # Profile variables
-        pres = ds.variables["PRES"][:]
-        temp = ds.variables["TEMP"][:]
-        psal = ds.variables["PSAL"][:]
-
-        # Loop over profiles (cycles)
-        for i in range(len(cycles)):
-            try:
-                cycle = int(cycles[i])
-                time_val = times[i].isoformat() if hasattr(times[i], "isoformat") else str(times[i])
-                lat = float(latitudes[i])
-                lon = float(longitudes[i])
-
-                pres_profile = pres[i, :]
-                temp_profile = temp[i, :]
-                psal_profile = psal[i, :]
-
-                pres_avg = float(np.nanmean(pres_profile)) if np.any(~pres_profile.mask) else None
-                temp_avg = float(np.nanmean(temp_profile)) if np.any(~temp_profile.mask) else None
-                psal_avg = float(np.nanmean(psal_profile)) if np.any(~psal_profile.mask) else None
-
-                # New debugging print statement
-                print(f"Attempting to insert: ID={float_id}, Cycle={cycle}, Time={time_val}, Lat={lat}, Lon={lon}, Pres={pres_avg}, Temp={temp_avg}, Sal={psal_avg}")
-                
-                cur.execute("""
-                    INSERT INTO argo_profile_data
-                    (float_id, cycle_number, juld, latitude, longitude, pressure, temperature, salinity)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (float_id, cycle, time_val, lat, lon, pres_avg, temp_avg, psal_avg))
-                
-                # Commit after each successful insert
-                conn.commit()
-
-            except Exception as e:
-                # If an error occurs, print it and roll back the transaction
-                print(f"❌ ERROR on Cycle {cycle} in {os.path.basename(nc_file)}: {e}")
-                conn.rollback() 
-        
-        ds.close()
+        with Dataset(nc_file, "r") as ds:
+            # Extract metadata
+            # One platform number per profile; a file holds profiles from many floats
+            float_ids = [platform.replace("\x00", "").strip() for platform in chartostring(ds.variables["PLATFORM_NUMBER"][:]).tolist()]
+            cycles = ds.variables["CYCLE_NUMBER"][:]
+            julds = ds.variables["JULD"][:]
+            latitudes = ds.variables["LATITUDE"][:]
+            longitudes = ds.variables["LONGITUDE"][:]
+
+            # Convert JULD → datetime
+            time_units = ds.variables["JULD"].units
+            time_calendar = getattr(ds.variables["JULD"], "calendar", "standard")
+            times = num2date(julds, units=time_units, calendar=time_calendar,
+                             only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+
+            # Per-profile averages of the profile variables, reduced over all levels in one pass
+            pres_avgs = profile_means(ds.variables["PRES"])
+            temp_avgs = profile_means(ds.variables["TEMP"])
+            psal_avgs = profile_means(ds.variables["PSAL"])
+
+        rows = [
+            (float_id, cycle, time_val, lat, lon, pres_avg, temp_avg, psal_avg)
+            for float_id, cycle, time_val, lat, lon, pres_avg, temp_avg, psal_avg in zip(
+                float_ids, cycles.tolist(), times.tolist(), latitudes.tolist(), longitudes.tolist(),
+                pres_avgs, temp_avgs, psal_avgs
+            )
+        ]
+
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                insert_rows(conn, cur, rows, nc_file)
+        finally:
+            conn.close()
 
     except Exception as e:
         # This will catch errors in opening the file or reading metadata
         print(f"❌ FATAL ERROR processing file {nc_file}: {e}")
 
-# ✅ Process all .nc files in a folder
-folder = "E:/sih/prototype/"   # change this to your folder path
-for file in os.listdir(folder):
-    if file.endswith(".nc"):
-        process_nc_file(os.path.join(folder, file))
-cur.close()
-conn.close()
\ No newline at end of file
+# ✅ Process all .nc files in a folder, one file per worker process
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    create_table()
+    folder = "E:/sih/prototype/"   # change this to your folder path
+    paths = [os.path.join(folder, file) for file in os.listdir(folder) if file.endswith(".nc")]
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(process_nc_file, paths))
\ No newline at end of file
@@ -1,12 +1,18 @@
 import os
-import pandas as pd
+import asyncio
+import hashlib
+import diskcache
+import numpy as np
 import psycopg2
 import chromadb
+import torch
 from sentence_transformers import SentenceTransformer
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
 from dotenv import load_dotenv
 import json
 import math
+import orjson
 
 # ==============================================================================
 # 1. SETUP AND CONFIGURATION
@@ -23,6 +29,11 @@ if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY not found in .env file.")
 genai.configure(api_key=GEMINI_API_KEY)
 gemini_model = genai.GenerativeModel('gemini-1.5-flash')
+GEMINI_CONCURRENCY = 16   # max in-flight Gemini requests
+GEMINI_MAX_RETRIES = 5    # attempts per record when rate limited (HTTP 429)
+
+# Gemini outputs already generated, so a resumed or re-run page does not pay for them again
+GEMINI_CACHE = diskcache.Cache("./gemini_cache")
 
 # Database connection details
 DB_NAME = os.getenv("DB_NAME")
@@ -34,16 +45,39 @@ def get_db_connection():
     """Establishes and returns a connection to the PostgreSQL database."""
     return psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST)
 
+def _detect_device():
+    """Picks the fastest available device for the embedding model: CUDA, then Apple MPS, then CPU."""
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+# Embedding model and ChromaDB collection, loaded once and reused for every page
+EMBEDDING_MODEL = SentenceTransformer('all-MiniLM-L6-v2', device=_detect_device())
+CHROMA_CLIENT = chromadb.PersistentClient(path="./argo_chroma_db_final")
+CHROMA_COLLECTION = CHROMA_CLIENT.get_or_create_collection("argo_ocean_docs")
+
+def encode_documents(documents):
+    """
+    Encodes documents grouped by length so each sub-batch pads to a similar size,
+    then restores the original order.
+    """
+    order = sorted(range(len(documents)), key=lambda i: len(documents[i]))
+    sorted_docs = [documents[i] for i in order]
+    # No autograd bookkeeping, and the tensor stays on the device until the single copy back
+    with torch.inference_mode():
+        emb_sorted = EMBEDDING_MODEL.encode(sorted_docs, batch_size=64, convert_to_tensor=True)
+        embeddings = torch.empty_like(emb_sorted)
+        embeddings[order] = emb_sorted
+    # Kept as a compact float32 array; Chroma takes it as-is instead of 384 boxed Python floats per document
+    return embeddings.cpu().numpy().astype(np.float32, copy=False)
+
 # ==============================================================================
 # 2. THE REVISED GEMINI PROMPT
 # ==============================================================================
 
-def get_gemini_prompt(record_json: str):
-    """
-    Creates the revised, detailed prompt for Gemini to generate structured
-    oceanographic documentation.
-    """
-    return f"""
+GEMINI_PROMPT_HEAD = """
     You are an expert oceanographer AI assistant. Your task is to create a concise, human-readable summary and structured documentation for a single ARGO float based on its raw measurement data.
 
     Input: A JSON object representing a row of data from the float's profile measurements.
@@ -60,30 +94,89 @@ def get_gemini_prompt(record_json: str):
     Output Format: Provide the final answer in a single, clean JSON object. Do not add any text before or after the JSON.
 
     ```json
-    {{
+    {
       "platform_id": <platform_id>,
       "region": "<primary region or ocean basin>",
       "time_range": "<start date (YYYY-MM-DD) to end date (YYYY-MM-DD)>",
       "summary": "<human-readable text summary combining trajectory, time, and key findings>",
-      "oceanographic_features": {{
+      "oceanographic_features": {
         "max_temperature_celsius": <value or null>,
         "min_salinity_psu": <value or null>,
         "significant_anomalies": "<brief note on any anomalies or 'normal conditions'>"
-      }}
-    }}
+      }
+    }
     ```
     
     Here is the data:
-    {record_json}
     """
 
+def get_gemini_prompt(record_json: str):
+    """
+    Creates the revised, detailed prompt for Gemini to generate structured
+    oceanographic documentation.
+    """
+    return GEMINI_PROMPT_HEAD + record_json + "\n    "
+
+async def summarize_record(semaphore, index, prompt: str):
+    """
+    Asks Gemini to document a single record and returns its parsed JSON output, backing off
+    exponentially while the API is rate limiting. Returns None if the record could not be documented.
+    """
+    try:
+        async with semaphore:
+            for attempt in range(GEMINI_MAX_RETRIES):
+                try:
+                    response = await gemini_model.generate_content_async(prompt)
+                    break
+                except ResourceExhausted:
+                    if attempt == GEMINI_MAX_RETRIES - 1:
+                        raise
+                    await asyncio.sleep(2 ** attempt)
+        cleaned_response = response.text.strip().replace('```json', '').replace('```', '')
+        gemini_output = json.loads(cleaned_response)
+        if not isinstance(gemini_output, dict):
+            raise ValueError("expected a JSON object")
+        return gemini_output
+    except Exception as e:
+        print(f"⚠️ Warning: Could not process Gemini response for record {index}. Error: {e}")
+        return None
+
+async def generate_summaries(records):
+    """
+    Documents a batch of (index, record_json) pairs and returns their summaries in the same order,
+    with None for records that failed. Cached outputs are looked up before any request is sent and
+    new ones stored after the batch finishes, so the blocking cache never stalls in-flight requests.
+    """
+    prompts = [get_gemini_prompt(record_json) for _, record_json in records]
+    # Keyed on the whole prompt, so editing the prompt text invalidates old entries
+    cache_keys = [hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest() for prompt in prompts]
+    outputs = [GEMINI_CACHE.get(cache_key) for cache_key in cache_keys]
+    misses = [i for i, output in enumerate(outputs) if output is None]
+
+    semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    fetched = await asyncio.gather(*(summarize_record(semaphore, records[i][0], prompts[i]) for i in misses))
+
+    for i, gemini_output in zip(misses, fetched):
+        if gemini_output is not None:
+            GEMINI_CACHE[cache_keys[i]] = gemini_output
+            outputs[i] = gemini_output
+    return [None if output is None else output.get("summary", "Summary not available.") for output in outputs]
+
+def to_chroma_metadata(record: dict):
+    """ChromaDB metadata only accepts str, int, float and bool, so other values (dates, decimals) are stringified."""
+    return {
+        key: value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+        for key, value in record.items()
+    }
+
 # ==============================================================================
 # 3. DATA FETCHING, DOCUMENTATION, AND INDEXING (CORRECTED FUNCTION)
 # ==============================================================================
 
-def fetch_process_and_index_data(table_name: str, batch_size: int = 100, page_number: int = 1):
+async def fetch_process_and_index_data(table_name: str, batch_size: int = 100, page_number: int = 1):
     """
     Fetches a specific batch/page of data from PostgreSQL, processes it, and indexes it.
+    Records Gemini could not document are left out of the index and their ids logged.
     """
     print(f"🚀 Processing Page {page_number} (Records { (page_number-1)*batch_size + 1 } to { page_number*batch_size })...")
     
@@ -93,9 +186,14 @@ def fetch_process_and_index_data(table_name: str, batch_size: int = 100, page_nu
     try:
         with get_db_connection() as conn:
             query = f"SELECT * FROM {table_name} ORDER BY profile_date DESC LIMIT %s OFFSET %s;"
-            df = pd.read_sql_query(query, conn, params=(batch_size, offset))
-        print(f"✅ Successfully fetched {len(df)} records.")
-        if len(df) == 0:
+            # A page is only batch_size rows, so fetch them in one go as plain tuples (no DataFrame)
+            with conn.cursor() as cur:
+                cur.execute(query, (batch_size, offset))
+                rows = cur.fetchall()
+                columns = [desc[0] for desc in cur.description]
+        records = [dict(zip(columns, row)) for row in rows]
+        print(f"✅ Successfully fetched {len(records)} records.")
+        if len(records) == 0:
             print("No more records to process for this batch.")
             return
     except Exception as e:
@@ -104,40 +202,36 @@ def fetch_process_and_index_data(table_name: str, batch_size: int = 100, page_nu
 
     # --- Step 2: Generate Documentation with Gemini ---
     print("🤖 Generating advanced oceanographic documentation with Gemini...")
-    summaries_for_chroma = []
-    
-    for index, row in df.iterrows():
-        record_json = row.to_json(default_handler=str)
-        prompt = get_gemini_prompt(record_json)
-        
-        try:
-            response = gemini_model.generate_content(prompt)
-            cleaned_response = response.text.strip().replace('```json', '').replace('```', '')
-            gemini_output = json.loads(cleaned_response)
-            summaries_for_chroma.append(gemini_output.get("summary", "Summary not available."))
-        except Exception as e:
-            print(f"⚠️ Warning: Could not process Gemini response for record {index}. Error: {e}")
-            summaries_for_chroma.append(f"Documentation failed for record {index}.")
+    record_jsons = [(index, orjson.dumps(record, default=str).decode()) for index, record in enumerate(records)]
+    summaries = await generate_summaries(record_jsons)
+    all_ids = [str(record['id']) for record in records] if 'id' in columns else [str(offset + i) for i in range(len(records))]
+
+    # Failed records are skipped rather than indexed with a placeholder, so one bad record can't block the run
+    failed_ids = [record_id for record_id, summary in zip(all_ids, summaries) if summary is None]
+    if failed_ids:
+        print(f"⚠️ Warning: Skipping {len(failed_ids)} undocumented records with ids: {', '.join(failed_ids)}")
+    documented = [i for i, summary in enumerate(summaries) if summary is not None]
+    if not documented:
+        print("No documented records to index for this batch.")
+        return
 
     # --- Step 3: Index the Summaries into ChromaDB ---
     print("⚡️ Creating embeddings and indexing into ChromaDB...")
     
-    embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-    chroma_client = chromadb.PersistentClient(path="./argo_chroma_db_final")
-    collection = chroma_client.get_or_create_collection("argo_ocean_docs")
+    documents = [summaries[i] for i in documented]
+    ids = [all_ids[i] for i in documented]
+    records = [records[i] for i in documented]
 
-    documents = summaries_for_chroma
-    ids = df['id'].astype(str).tolist() if 'id' in df.columns else [str(i) for i in df.index]
-
-    embeddings = embedding_model.encode(documents)
-    collection.add(
-        embeddings=embeddings.tolist(),
+    embeddings = encode_documents(documents)
+    # Upsert so re-running a page after a crash is idempotent; a page is already a bounded batch
+    CHROMA_COLLECTION.upsert(
+        embeddings=embeddings,
         documents=documents,
         ids=ids,
-        metadatas=df.to_dict('records')
+        metadatas=[to_chroma_metadata(record) for record in records]
     )
     
-    print(f"✅ Successfully indexed {collection.count()} documents into ChromaDB.")
+    print(f"✅ Successfully indexed {CHROMA_COLLECTION.count()} documents into ChromaDB.")
 
 # ==============================================================================
 # 4. MAIN EXECUTION (FAULT-TOLERANT & AUTOMATED)
@@ -178,19 +272,23 @@ if __name__ == "__main__":
         
         print(f"Found {total_records} records. Processing from page {start_page} to {total_pages}.")
         
-        for page in range(start_page, total_pages + 1):
-            try:
-                fetch_process_and_index_data(
-                    table_name=TABLE_TO_PROCESS, 
-                    batch_size=BATCH_SIZE, 
-                    page_number=page
-                )
-                log_completed_page(page)
-                print(f"✅ Successfully completed and logged page {page}.")
-            except Exception as e:
-                print(f"❌ CRITICAL ERROR on page {page}: {e}")
-                print("Stopping script. You can restart it to resume from this page.")
-                break
+        # One event loop for the whole run: the Gemini async client is bound to the loop it was created on
+        async def process_pages():
+            for page in range(start_page, total_pages + 1):
+                try:
+                    await fetch_process_and_index_data(
+                        table_name=TABLE_TO_PROCESS, 
+                        batch_size=BATCH_SIZE, 
+                        page_number=page
+                    )
+                    log_completed_page(page)
+                    print(f"✅ Successfully completed and logged page {page}.")
+                except Exception as e:
+                    print(f"❌ CRITICAL ERROR on page {page}: {e}")
+                    print("Stopping script. You can restart it to resume from this page.")
+                    break
+
+        asyncio.run(process_pages())
             
         if get_start_page() > total_pages:
             print("\n🎉 All batches have been processed successfully!")
\ No newline at end of file
@@ -1,11 +1,16 @@
 import os
 import json
+import asyncio
+import hashlib
 import chromadb
+import orjson
 import pandas as pd
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Request, Response
 from openai import api_key
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from sqlalchemy import create_engine, text
 import google.generativeai as genai
@@ -26,12 +31,15 @@ genai.configure(api_key=api_key)
 model = genai.GenerativeModel("gemini-pro-latest")
 
 DB_URL = f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
-DB_ENGINE = create_engine(DB_URL)
+DB_ENGINE = create_engine(DB_URL, pool_size=16, max_overflow=32, pool_pre_ping=True)
 
 CHROMA_CLIENT = chromadb.HttpClient(host=chroma_host, port=int(chroma_port))
 CHROMA_COLLECTION = CHROMA_CLIENT.get_collection(name="ocean_context")
 
-app = FastAPI()
+# Serialized /trajectories JSON, keyed by a cheap fingerprint of argo_profiles
+TRAJECTORY_CACHE = TTLCache(maxsize=1, ttl=300)
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 origins = ["*"] 
 
@@ -96,6 +104,13 @@ The JSON object should have one key: "queries".
 Your Plan:
 """
 
+# The schemas never change, so fill them in once and leave only the user query per request
+PLANNING_PROMPT = PLANNING_PROMPT_TEMPLATE.format(
+    postgres_schema=POSTGRES_SCHEMA,
+    vector_db_schema=VECTOR_DB_SCHEMA,
+    user_query="{user_query}"
+)
+
 SYNTHESIS_PROMPT_TEMPLATE = """
 You are a helpful oceanographer AI assistant. You have been provided with data retrieved
 from a database based on a user's question.
@@ -124,31 +139,75 @@ def clean_null_bytes(text: str) -> str:
 class UserRequest(BaseModel):
     query: str
 
+def run_postgres_query(query: str) -> list:
+    """Runs a planned SQL query and returns its rows as records."""
+    with DB_ENGINE.connect() as connection:
+        df = pd.read_sql(text(query), connection)
+    return df.to_dict(orient="records")
+
+def run_vector_query(query: str) -> list:
+    """Returns the closest context documents for a planned vector search."""
+    results = CHROMA_COLLECTION.query(query_texts=[query], n_results=2)
+    return results["documents"]
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Checks an If-None-Match header (a list of tags or *) against etag using weak comparison."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
 @app.get("/trajectories")
-async def get_trajectories():
+async def get_trajectories(request: Request):
     """
     Retrieves the ordered trajectory for every float in the database.
     """
     try:
+        with DB_ENGINE.connect() as connection:
+            # Cheap on every request: max(id) is read from the primary key index and the row-change
+            # counters from table statistics, so backfills, updates and deletions all change the key
+            table_version = tuple(connection.execute(text("""
+                SELECT 
+                    (SELECT max(id) FROM argo_profiles), 
+                    n_tup_ins, 
+                    n_tup_upd, 
+                    n_tup_del 
+                FROM 
+                    pg_stat_user_tables 
+                WHERE 
+                    relid = 'argo_profiles'::regclass;
+            """)).one())
+        etag = '"' + hashlib.sha1(str(table_version).encode()).hexdigest() + '"'
+
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        body = TRAJECTORY_CACHE.get(table_version)
+        if body is not None:
+            return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+        # Postgres builds each float's ordered [lat, lon] path, so no reshaping is needed here
         query = text("""
             SELECT 
                 platform_id, 
-                latitude, 
-                longitude 
+                array_agg(ARRAY[latitude, longitude] ORDER BY timestamp ASC) AS path
             FROM 
                 argo_profiles 
+            GROUP BY 
+                platform_id
             ORDER BY 
-                platform_id, timestamp ASC;
+                platform_id;
         """)
         
         with DB_ENGINE.connect() as connection:
-            df = pd.read_sql(query, connection)
+            rows = connection.execute(query).all()
 
-        trajectories = {}
-        for platform_id, group in df.groupby('platform_id'):
-            trajectories[str(platform_id)] = group[['latitude', 'longitude']].values.tolist()
+        trajectories = {str(platform_id): path for platform_id, path in rows}
+        # Serialize once with orjson and return the bytes as-is, skipping FastAPI's jsonable_encoder pass
+        body = orjson.dumps(trajectories)
+        TRAJECTORY_CACHE[table_version] = body
             
-        return trajectories
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -156,11 +215,7 @@ async def get_trajectories():
 @app.post("/analyze")
 async def analyze_query(request: UserRequest):
     try:
-        planning_prompt = PLANNING_PROMPT_TEMPLATE.format(
-            postgres_schema=POSTGRES_SCHEMA,
-            vector_db_schema=VECTOR_DB_SCHEMA,
-            user_query=request.query
-        )
+        planning_prompt = PLANNING_PROMPT.format(user_query=request.query)
         plan_response = model.generate_content(planning_prompt)
 
         plan_response_text = clean_null_bytes(plan_response.text.strip())
@@ -173,21 +228,28 @@ async def analyze_query(request: UserRequest):
         retrieved_data = {}
         data_for_frontend = {}
 
-        for q in plan["queries"]:
-            if q["tool"] == "postgres":
-                with DB_ENGINE.connect() as connection:
-                    df = pd.read_sql(text(q["query"]), connection)
-                    data_for_frontend[f"sql_result_{len(data_for_frontend)}"] = df.to_dict(orient="records")
+        # Postgres and Chroma calls are blocking I/O, so run them side by side in worker threads
+        queries = [q for q in plan["queries"] if q["tool"] in ("postgres", "vector")]
+        results = await asyncio.gather(*(
+            asyncio.to_thread(run_postgres_query if q["tool"] == "postgres" else run_vector_query, q["query"])
+            for q in queries
+        ))
 
-            elif q["tool"] == "vector":
-                results = CHROMA_COLLECTION.query(query_texts=[q["query"]], n_results=2)
-                retrieved_data[f"vector_result_{len(retrieved_data)}"] = results["documents"]
+        for q, result in zip(queries, results):
+            if q["tool"] == "postgres":
+                data_for_frontend[f"sql_result_{len(data_for_frontend)}"] = result
+            else:
+                retrieved_data[f"vector_result_{len(retrieved_data)}"] = result
 
         retrieved_data["structured_data"] = data_for_frontend
 
         synthesis_prompt = SYNTHESIS_PROMPT_TEMPLATE.format(
             user_query=request.query,
-            retrieved_data=json.dumps(retrieved_data, indent=2, default=str)
+            retrieved_data=orjson.dumps(
+                retrieved_data,
+                default=str,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+            ).decode()
         )
 
         insight_response = model.generate_content(synthesis_prompt)